@@ -6,7 +6,10 @@ import random
 import wsgiref.handlers
 import yaml
 
-from django.utils import simplejson as json
+try:
+  import ujson as json
+except ImportError:
+  from django.utils import simplejson as json
 
 from models import game as game_module
 from models.game import Destination
@@ -64,6 +67,20 @@ class GameHandler(webapp.RequestHandler):
   
   def __init__(self):
     self.game = None
+    self.user = None
+    self.user_email = None
+
+  def CurrentUser(self):
+    """Get the current user, looking it up at most once per request."""
+    if self.user is None:
+      self.user = users.get_current_user()
+    return self.user
+
+  def CurrentUserEmail(self):
+    """Get the current user's email, or None if there is no current user."""
+    if self.user_email is None and self.CurrentUser():
+      self.user_email = self.CurrentUser().email()
+    return self.user_email
 
   def GetGameKeyName(self, game_id):
     """For a given game id, get a string representing the game's key name.
@@ -143,10 +160,10 @@ class GameHandler(webapp.RequestHandler):
       return False
     
     try:
-      self.game = db.model_from_protobuf(encoded)
+      self.game = Game.FromMemcacheBlob(encoded)
       return True
     except db.Error, e:
-      logging.warn("Game Model decode from protobuf error: %s" % e)
+      logging.warn("Game Model decode from protobuf error: %s", e)
       return False
     
   def LoadFromDatastore(self, key):
@@ -164,15 +181,15 @@ class GameHandler(webapp.RequestHandler):
     game.Put(force_db_put)
     
   def Authorize(self, game):
-    user = users.get_current_user()
-    if not user:
+    email = self.CurrentUserEmail()
+    if not email:
       raise AuthorizationError("Request to get a game by a non-logged-in-user.")
     else:
-      authorized = (game.GetPlayer(user.email()) is not None)
+      authorized = game.HasPlayer(email)
       if not authorized:
         raise AuthorizationError(
             "Request to get a game by a user who is not part of the game "
-            "(unauthorized user: %s)." % user.email())
+            "(unauthorized user: %s)." % email)
   
   def OutputGame(self, game):
     """Write the game data to the output, serialized as YAML.
@@ -183,21 +200,20 @@ class GameHandler(webapp.RequestHandler):
     dictionary = {}
     dictionary["game_id"] = game.Id()
     dictionary["owner"] = game.owner.email()
-    dictionary["player"] = users.get_current_user().email()
+    dictionary["player"] = self.CurrentUserEmail()
     
     # We always return the location of all the players, as it's important that
     # the clients see all player state changes.
-    dictionary["players"] = [x.DictForJson() for 
-                             x in 
-                             game.Players()]
+    dictionary["players"] = list(game.PlayerDicts())
 
-    dictionary["zombies"] = [x.DictForJson() for 
+    is_visible = game.VisibilityFilter()
+    dictionary["zombies"] = [x for 
                              x in 
-                             game.Zombies() if 
-                             game.IsVisible(x)]
+                             game.ZombieDicts() if 
+                             is_visible(x["lat"], x["lon"])]
     
-    if game.destination is not None:
-      destination_dict = json.loads(game.destination)
+    destination_dict = game.DestinationDict()
+    if destination_dict is not None:
       dictionary["destination"] = destination_dict
     
     if self.request.get(DEBUG_PARAMETER):
@@ -245,7 +261,7 @@ class GetHandler(GameHandler):
   def AdvanceAndPutGame(self, game):
     players_infected = self._PlayersInfected(game)
     players_converted = self._PlayersConverted(game)
-    game.Advance()
+    game.Advance(self.CurrentUserEmail())
     # For some reason we lose some state when we only put the game to memcache,
     # so for now we force put it to the datastore every time.
     self.PutGame(game, False)
@@ -269,16 +285,13 @@ class PutHandler(GetHandler):
   
   def get(self):
     """Task: Parse the input data and update the game state."""
-    user = users.get_current_user()
-    if user:
+    if self.CurrentUser():
       game = self._PutAndAdvanceGame()
       self.OutputGame(game)
     else:
       self.RedirectToLogin()
       
   def UpdateCurrentPlayer(self, game):
-    user = users.get_current_user()
-
     lat = None
     lon = None
     try:
@@ -287,9 +300,8 @@ class PutHandler(GetHandler):
     except ValueError, e:
       raise MalformedRequestError(e)
     
-    player = game.GetPlayer(user.email())
-    player.SetLocation(float(self.request.get(LATITUDE_PARAMETER)),
-                       float(self.request.get(LONGITUDE_PARAMETER)))
+    player = game.GetPlayer(self.CurrentUserEmail())
+    player.SetLocation(lat, lon)
     if self.request.get(FORTIFY_PARAMETER):
       player.Fortify()
     game.SetPlayer(player)
@@ -313,7 +325,7 @@ class StartHandler(PutHandler):
   
   def get(self):
     game = self.GetGame()
-    if users.get_current_user() != game.owner:
+    if self.CurrentUser() != game.owner:
       raise AuthorizationError("Only the game owner can start the game.")
     
     # Set the destination
@@ -344,16 +356,16 @@ class AddFriendHandler(GameHandler):
       return
     
     message = mail.EmailMessage()
-    message.sender = users.get_current_user().email()
+    message.sender = self.CurrentUserEmail()
     message.to = to_addr
     message.subject = ("%s wants to save you from Zombies!" % 
-                       users.get_current_user().nickname())
+                       self.CurrentUser().nickname())
     
     game_link = self.UrlForGameJoin(game)
     # TODO: This should be a rendered Django template.
     message.body = """%s wants to save you from Zombies!
     
     Click on this link on your iPhone or Android device to run far, far away: %s
-    """ % (users.get_current_user().nickname(), game_link)
+    """ % (self.CurrentUser().nickname(), game_link)
 
     message.send()
\ No newline at end of file
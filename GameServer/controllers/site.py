@@ -3,7 +3,6 @@ import os
 import random
 
 from controllers import api
-from google.appengine.api import users
 from google.appengine.ext import db
 from google.appengine.ext.webapp import template
 from models.game import Game
@@ -17,7 +16,7 @@ GLOBAL_GAME_ID = 1
 class HomepageHandler(api.GameHandler):
   
   def get(self):
-    user = users.get_current_user()
+    user = self.CurrentUser()
     if not user:
       # If the user isn't logged in, then we render a frame around the
       # homepage, so that the iPhone won't register that we are opening
@@ -32,10 +31,10 @@ class HomepageHandler(api.GameHandler):
       game = self.GetLastGame(user)
 
       if game is None:
-        logging.info("Creating a new game for player %s." % user.email())
+        logging.info("Creating a new game for player %s.", user.email())
         game = self.CreateGame(user)
       else:
-        logging.info("Player %s playing game %d" % (user.email(), game.Id()))
+        logging.info("Player %s playing game %d", user.email(), game.Id())
         
       debug = "false"
       if self.request.get(api.DEBUG_PARAMETER) == "1":
@@ -69,7 +68,7 @@ class HomepageHandler(api.GameHandler):
         
   def CreateGame(self, user, game_id=None):
     def CreateNewGameIfAbsent(game_id):
-      logging.info("Creating new game with id %d" % game_id)
+      logging.info("Creating new game with id %d", game_id)
       game_key = self.GetGameKeyName(game_id)
       if Game.get_by_key_name(game_key) is None:
         game = Game(key_name=game_key, owner=user)
@@ -95,7 +94,7 @@ class HomepageHandler(api.GameHandler):
     return game
   
   def AddPlayerToGame(self, game, user):
-    logging.debug("Adding player %s to game %d" % (user.email(), game.Id()))
+    logging.debug("Adding player %s to game %d", user.email(), game.Id())
     if game.GetPlayer(user.email()) is not None:
       return game
     
@@ -108,7 +107,7 @@ class HomepageHandler(api.GameHandler):
 class JoinHandler(HomepageHandler):
 
   def get(self):
-    user = users.get_current_user()
+    user = self.CurrentUser()
     if not user:
       self.RenderLogin()
     else:
@@ -117,7 +116,7 @@ class JoinHandler(HomepageHandler):
         self.CreateGame(user, game_id)
       
       game = self.GetGame(authorize=False)
-      logging.info("Got game with id %d." % game.Id())
+      logging.info("Got game with id %d.", game.Id())
       self.AddPlayerToGame(game, user)
       logging.info("Added player to game.")
       self.PutGame(game, True)
@@ -128,7 +127,7 @@ class JoinHandler(HomepageHandler):
 class NewHandler(HomepageHandler):
   
   def get(self):
-    user = users.get_current_user()
+    user = self.CurrentUser()
     if not user:
       self.RenderLogin()
     else:
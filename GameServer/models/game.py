@@ -5,12 +5,16 @@ import random
 import time
 import uuid
 
-from django.utils import simplejson as json
+try:
+  import ujson as json
+except ImportError:
+  from django.utils import simplejson as json
 from google.appengine.api import memcache
-from google.appengine.api import users
 from google.appengine.ext import db
 
 RADIUS_OF_EARTH_METERS = 6378100
+DEGREES_TO_RADIANS = math.pi / 180
+METERS_PER_DEGREE_LAT = RADIUS_OF_EARTH_METERS * DEGREES_TO_RADIANS
 TRIGGER_DISTANCE_METERS = 15
 ZOMBIE_VISION_DISTANCE_METERS = 200
 PLAYER_VISION_DISTANCE_METERS = 500
@@ -56,17 +60,166 @@ class InvalidLocationError(Error):
 
 
 def DistanceBetween(aLat, aLon, bLat, bLon):
-    dlat = aLat - bLat
-    dlon = aLon - bLon
-    a = math.sin(math.radians(dlat/2)) ** 2 + \
-        math.cos(math.radians(aLat)) * \
-        math.cos(math.radians(bLat)) * \
-        math.sin(math.radians(dlon / 2)) ** 2
+    aLat = aLat * DEGREES_TO_RADIANS
+    bLat = bLat * DEGREES_TO_RADIANS
+    a = math.sin((aLat - bLat) / 2) ** 2 + \
+        math.cos(aLat) * \
+        math.cos(bLat) * \
+        math.sin((aLon - bLon) * DEGREES_TO_RADIANS / 2) ** 2
     greatCircleDistance = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
     distance = RADIUS_OF_EARTH_METERS * greatCircleDistance
     return distance
 
 
+def ApproxDistanceBetween(aLat, aLon, bLat, bLon):
+  """An equirectangular approximation of DistanceBetween, which scales the
+  longitude difference by the mean of the two latitudes' cosines.
+  
+  Much cheaper than the haversine formula, and accurate to well under a meter
+  for the few hundred meters of zombie vision, triggers and fortifications.
+  The error grows with distance, so use DistanceBetween where exact long
+  distances matter.
+  """
+  cos_mean = (math.cos(aLat * DEGREES_TO_RADIANS) +
+              math.cos(bLat * DEGREES_TO_RADIANS)) / 2
+  return METERS_PER_DEGREE_LAT * math.hypot(aLat - bLat,
+                                            (aLon - bLon) * cos_mean)
+
+
+def LatLonPoints(entities):
+  """Convert a list of located entities to a list of (lat, lon, cos(lat))
+  tuples, suitable for passing to PointsWithin and SimulateZombie.
+  
+  The conversion is done once so that the trig for each point is not repeated
+  every time a distance to it is computed.
+  """
+  points = []
+  for entity in entities:
+    lat = entity.Lat()
+    points.append((lat, entity.Lon(), math.cos(lat * DEGREES_TO_RADIANS)))
+  return points
+
+
+def _SquaredDistancesWithin(lat, lon, points, max_distance):
+  """Iterate over the points produced by LatLonPoints that are less than
+  max_distance meters from (lat, lon), using the equirectangular approximation
+  (see ApproxDistanceBetween).
+  
+  The distance between two points is at least the distance between their
+  latitudes, so points whose latitude alone is too far away are skipped
+  without computing the full distance.  Most points in a game are far apart
+  compared to the trigger and vision distances, so that skips most of them.
+  
+  Distances are compared squared and in degrees of latitude, so that callers
+  only take square roots for the points they actually need.
+  
+  Yields:
+    (index, squared distance in degrees) tuples.
+  """
+  max_dlat = max_distance / METERS_PER_DEGREE_LAT
+  max_dlat_squared = max_dlat * max_dlat
+  cos_lat = math.cos(lat * DEGREES_TO_RADIANS)
+  for i, (p_lat, p_lon, p_cos_lat) in enumerate(points):
+    dlat = lat - p_lat
+    if abs(dlat) > max_dlat:
+      continue
+    x = (lon - p_lon) * (cos_lat + p_cos_lat) / 2
+    d_squared = dlat * dlat + x * x
+    if d_squared < max_dlat_squared:
+      yield i, d_squared
+
+
+def PointsWithin(lat, lon, points, max_distance):
+  """Find the points produced by LatLonPoints that are less than max_distance
+  meters from (lat, lon); see _SquaredDistancesWithin.
+  
+  Returns:
+    A list of (index, distance) tuples.
+  """
+  sqrt = math.sqrt
+  return [(i, METERS_PER_DEGREE_LAT * sqrt(d_squared))
+          for i, d_squared in
+          _SquaredDistancesWithin(lat, lon, points, max_distance)]
+
+
+def ClosestPoint(lat, lon, points, max_distance):
+  """Find the point produced by LatLonPoints that is closest to (lat, lon), of
+  those that are less than max_distance meters away.
+  
+  Returns:
+    An (index, distance) tuple, or (None, None) if there are no such points.
+  """
+  min_index = None
+  min_d_squared = None
+  for i, d_squared in _SquaredDistancesWithin(lat, lon, points, max_distance):
+    if min_d_squared is None or d_squared < min_d_squared:
+      min_d_squared = d_squared
+      min_index = i
+  if min_index is None:
+    return None, None
+  return min_index, METERS_PER_DEGREE_LAT * math.sqrt(min_d_squared)
+
+
+def SimulateZombie(lat, lon, speed, seconds, player_points,
+                   fortification_points):
+  """Simulate a zombie's movement over some number of seconds, in 1-second
+  increments.
+  
+  This works purely on floats and the precomputed LatLonPoints, so that the
+  per-second loop doesn't construct or decode any Entities.
+  
+  Args:
+    lat, lon: The zombie's starting location.
+    speed: The zombie's speed in meters per second.
+    seconds: The number of seconds to simulate.
+    player_points: LatLonPoints of the players in play.
+    fortification_points: LatLonPoints of the fortifications in the game.
+  
+  Returns:
+    A (lat, lon, chasing) tuple of the zombie's new location and the index
+    into player_points of the player it is chasing, or None.
+  """
+  chasing = None
+  while seconds > 0:
+    chasing, min_distance = ClosestPoint(lat, lon, player_points,
+                                         ZOMBIE_VISION_DISTANCE_METERS)
+    
+    vector_lat = 0
+    vector_lon = 0
+    if chasing is not None:
+      # If we're chasing someone, move toward them.  But scale this by 1/2 so
+      # that if a zombie happens to be inside a fortification with a player,
+      # the zombie moves away instead of being perfectly balanced
+      vector_lat += (player_points[chasing][0] - lat) / 2
+      vector_lon += (player_points[chasing][1] - lon) / 2
+    
+    for i, distance in PointsWithin(lat, lon, fortification_points,
+                                    DEFAULT_FORTIFICATION_RADIUS_METERS):
+      vector_lat -= fortification_points[i][0] - lat
+      vector_lon -= fortification_points[i][1] - lon
+    
+    # If we don't have a particular goal in mind, just meander randomly.
+    if vector_lat == 0 and vector_lon == 0:
+      vector_lat = random.uniform(-1, 1)
+      vector_lon = random.uniform(-1, 1)
+    
+    # Don't travel more than the distance to our determined destination.
+    # The random meander target can be up to a degree or so away, where the
+    # approximation is less exact, but it's only used to scale a step of a
+    # meter or two, so its relative error barely changes the step.
+    distance_to_target = ApproxDistanceBetween(lat, lon,
+                                               lat + vector_lat,
+                                               lon + vector_lon)
+    if distance_to_target > 0:
+      magnitude = min(distance_to_target, min(seconds, 1) * speed) / \
+          distance_to_target
+      lat += vector_lat * magnitude
+      lon += vector_lon * magnitude
+    
+    seconds = seconds - 1
+  return lat, lon, chasing
+
+
 class Entity():
   """An Entity is the base class of every entity in the game.
   
@@ -121,6 +274,11 @@ class Entity():
   
   def DistanceFromLatLon(self, lat, lon):
     return DistanceBetween(self.Lat(), self.Lon(), lat, lon)
+  
+  def DistanceFromLatLonApprox(self, lat, lon):
+    """A cheaper DistanceFromLatLon for short distances; see
+    ApproxDistanceBetween."""
+    return ApproxDistanceBetween(self.Lat(), self.Lon(), lat, lon)
 
 
 class Trigger(Entity):
@@ -262,13 +420,14 @@ class Player(Trigger):
       player.Infect()
   
   def Fortify(self):
-    logging.info("Player %s fortifying." % self.ToString())
+    logging.info("Player %s fortifying.", self.Email())
     if not self.fortification:
       self.fortification = Fortification()
     
     if self.Lat() and self.Lon():
       self.fortification.SetLocation(self.Lat(), self.Lon())
-    logging.info("Player fortified: %s" % self.ToString())
+    logging.info("Player %s fortified at (%s, %s).",
+                 self.Email(), self.Lat(), self.Lon())
     self._Commit()
   
   def GetFortification(self):
@@ -290,81 +449,32 @@ class Zombie(Trigger):
   def Id(self):
     return self.guid
   
-  def Advance(self, seconds, player_iter, fortifications_iter):
+  def Advance(self, seconds, players, player_points, fortification_points):
     """Meander some distance.
     
     Args:
-      timedelta: a datetime.timedelta object indicating how much time has
-          elapsed since the last time we've advanced the game.
-      player_iter: An iterator that will walk over the players in the game.
+      seconds: The number of seconds that have elapsed since the last time
+          we've advanced the game.
+      players: A list of the players in play.
+      player_points: LatLonPoints(players).
+      fortification_points: LatLonPoints of the fortifications in the game.
     """
-    # Flatten the iterator to a list so that we can iterate over it several
-    # times.
-    players = [player for player in player_iter]
-    fortifications = [f for f in fortifications_iter]
-
-    # Advance in 1-second increments.
-    while seconds > 0:
-      self.ComputeChasing(players)
-      
-      vector = [0, 0]
-      
-      time = min(seconds, 1)
-      distance = time * self.speed
-      if self.chasing:
-        # If we're chasing someone, move toward them.  But scale this by 1/2 so
-        # that if a zombie happens to be inside a fortification with a player,
-        # the zombie moves away instead of being perfectly balanced
-        vector[0] += (self.chasing.Lat() - self.Lat()) / 2
-        vector[1] += (self.chasing.Lon() - self.Lon()) / 2
-
-      for fortification in fortifications:
-        if self.DistanceFrom(fortification) < \
-            DEFAULT_FORTIFICATION_RADIUS_METERS:
-          logging.debug("Zombie %s moving away from fortification." % self.Id())
-          vector[0] -= fortification.Lat() - self.Lat()
-          vector[1] -= fortification.Lon() - self.Lon()
-
-      # If we don't have a particular goal in mind, just meander randomly.
-      if vector[0] == 0 and vector[1] == 0:
-        vector[0] = random.uniform(-1, 1)
-        vector[1] = random.uniform(-1, 1)
-
-      lat = self.Lat() + vector[0]
-      lon = self.Lon() + vector[1]
-
-      # Don't travel more than the distance to our determined destination
-      distance = min(self.DistanceFromLatLon(lat, lon), distance)
-
-      self.MoveTowardsLatLon(lat, lon, distance)
-      
-      seconds = seconds - 1
-      
-  def MoveTowardsLatLon(self, lat, lon, distance):
-    dstToLatLon = self.DistanceFromLatLon(lat, lon)
-    magnitude = 0
-    if dstToLatLon > 0:
-      magnitude = distance / dstToLatLon
-    dLat = (lat - self.Lat()) * magnitude
-    dLon = (lon - self.Lon()) * magnitude
-    self.SetLocation(self.Lat() + dLat, self.Lon() + dLon)
-  
-  def ComputeChasing(self, player_iter):
-    min_distance = None
-    min_player = None
-    for player in player_iter:
-      distance = self.DistanceFrom(player)
-      if min_distance is None or distance < min_distance:
-        min_distance = distance
-        min_player = player
-    
-    if min_distance and min_distance < ZOMBIE_VISION_DISTANCE_METERS:
-      self.chasing = min_player
-      self.chasing_email = min_player.Email()
-    else:
+    if seconds <= 0:
+      return
+    lat, lon, chasing = SimulateZombie(self.Lat(),
+                                       self.Lon(),
+                                       self.speed,
+                                       seconds,
+                                       player_points,
+                                       fortification_points)
+    self.SetLocation(lat, lon)
+    if chasing is None:
       self.chasing = None
       self.chasing_email = None
-
+    else:
+      self.chasing = players[chasing]
+      self.chasing_email = self.chasing.Email()
+      
   def Trigger(self, player):
     player.Infect()
   
@@ -411,6 +521,7 @@ class Game(db.Model):
     self.lat = None
     self.lon = None
     self.window = None
+    self.decoded_destination = None
     
   def Put(self, force_db_put):
     """Put this game and the tiles in its window to the datastore.
@@ -424,10 +535,24 @@ class Game(db.Model):
       self.put()
       self.last_update_time = now
 
-    encoded = db.model_to_protobuf(self)
-    if not memcache.set(self.key().name(), encoded):
+    if not memcache.set(self.key().name(), self.ToMemcacheBlob()):
       logging.warn("Game set to Memcache failed.")
 
+  def ToMemcacheBlob(self):
+    """Encode this game for memcache, as the serialized protocol buffer of its
+    datastore entity.  Storing the string rather than the EntityProto means
+    memcache doesn't pickle it."""
+    return db.model_to_protobuf(self).Encode()
+
+  @classmethod
+  def FromMemcacheBlob(cls, blob):
+    """Decode a game encoded with ToMemcacheBlob, without a datastore hit.
+    
+    Raises:
+      db.Error: If the blob could not be decoded.
+    """
+    return db.model_from_protobuf(blob)
+
 
   def SetWindowLatLon(self, lat, lon):
     """Set the latitude and longitude of the game's operating window's center,
@@ -442,8 +567,8 @@ class Game(db.Model):
     if (self.window is None or 
         self.window.Lat() != self.lat or 
         self.window.Lon() != self.lon):
-      logging.debug("Constructing GameTileWindow for lat, lon (%f, %f)" %
-                    (self.lat, self.lon))
+      logging.debug("Constructing GameTileWindow for lat, lon (%f, %f)",
+                    self.lat, self.lon)
       self.window = GameTileWindow(self, 
                                    self.lat, 
                                    self.lon, 
@@ -451,14 +576,43 @@ class Game(db.Model):
     return self.window
   
   def IsVisible(self, entity):
-    if entity.Lat() is None or entity.Lon() is None:
-      logging.debug("Excluding an entity outside the visible window because "
-                    "it doesn't have a location.")
+    return self.IsLatLonVisible(entity.Lat(), entity.Lon())
+
+  def IsLatLonVisible(self, lat, lon):
+    if lat is None or lon is None:
+      logging.debug("Excluding an entity outside the visible window "
+                    "because it doesn't have a location.")
       return False
-    return DistanceBetween(self.lat,
-                           self.lon, 
-                           entity.Lat(),
-                           entity.Lon()) < PLAYER_VISION_DISTANCE_METERS
+    return (DistanceBetween(self.lat, self.lon, lat, lon) <
+            PLAYER_VISION_DISTANCE_METERS)
+  
+  def VisibilityFilter(self):
+    """Get a function of (lat, lon) equivalent to IsLatLonVisible, for use when
+    filtering many entities.  Everything that depends only on the window's
+    center is computed once, up front."""
+    center_lat = self.lat
+    center_lon = self.lon
+    center_cos_lat = math.cos(center_lat * DEGREES_TO_RADIANS)
+    half_d2r = DEGREES_TO_RADIANS / 2
+    # No two points further apart in latitude than this can be visible, so
+    # those can be excluded without computing the distance.
+    max_dlat = PLAYER_VISION_DISTANCE_METERS / METERS_PER_DEGREE_LAT
+    
+    def Filter(lat, lon):
+      if lat is None or lon is None:
+        logging.debug("Excluding an entity outside the visible window "
+                      "because it doesn't have a location.")
+        return False
+      if abs(lat - center_lat) > max_dlat:
+        return False
+      # The haversine formula, as in DistanceBetween.
+      a = math.sin((lat - center_lat) * half_d2r) ** 2 + \
+          math.cos(lat * DEGREES_TO_RADIANS) * center_cos_lat * \
+          math.sin((lon - center_lon) * half_d2r) ** 2
+      distance = RADIUS_OF_EARTH_METERS * 2 * \
+          math.atan2(math.sqrt(a), math.sqrt(1 - a))
+      return distance < PLAYER_VISION_DISTANCE_METERS
+    return Filter
 
   
   def Id(self):
@@ -471,9 +625,19 @@ class Game(db.Model):
     player loaded in view from the normal tile load conditions)."""
     return self._GameTileWindow().GetPlayer(email)
   
+  def HasPlayer(self, email):
+    """Whether the player with the given email is in the game, regardless of
+    the player's current location."""
+    return self._GameTileWindow().HasPlayer(email)
+  
   def Players(self):
-    for player in self._GameTileWindow().Players():
-      yield player
+    return self._GameTileWindow().Players()
+  
+  def PlayerDicts(self):
+    """Iterate over the players as dictionaries ready for json encoding,
+    without constructing Player objects."""
+    for player_dict in self._GameTileWindow().PlayerDicts():
+      yield player_dict
   
   def ZombiePlayers(self):
     for player in self.Players():
@@ -487,14 +651,23 @@ class Game(db.Model):
     Returns:
         Iterable of (player_index, player) tuples.
     """
+    is_visible = self.VisibilityFilter()
     for player in self.Players():
-      if (self.IsVisible(player) and
+      if (is_visible(player.Lat(), player.Lon()) and
           not player.HasReachedDestination() and
           not player.IsInfected()):
         yield player
   
-  def Fortifications(self):
-    for player in self.PlayersInPlay():
+  def Fortifications(self, players_in_play=None):
+    """Iterate over the fortifications in the game.
+    
+    Args:
+      players_in_play: The result of PlayersInPlay, if the caller already has
+          it.  If None, PlayersInPlay is called.
+    """
+    if players_in_play is None:
+      players_in_play = self.PlayersInPlay()
+    for player in players_in_play:
       if player.GetFortification():
         yield player.GetFortification()
     if self.destination:
@@ -510,23 +683,35 @@ class Game(db.Model):
     for zombie in self._GameTileWindow().Zombies():
       yield zombie
   
+  def ZombieDicts(self):
+    """Iterate over the zombies as dictionaries ready for json encoding."""
+    for zombie_dict in self._GameTileWindow().ZombieDicts():
+      yield zombie_dict
+  
   def NumZombies(self):
     return self._GameTileWindow().NumZombies()
   
-  def ZombiesAndInfectedPlayers(self):
-    entities = []
-    entities.extend(self.Zombies())
-    entities.extend(self.ZombiePlayers())
-    return entities
-  
   def SetZombie(self, zombie):
     self._GameTileWindow().SetZombie(zombie)
   
   def Destination(self):
-    return Destination(self.destination)
+    # Built from the decoded dictionary, so that repeated calls don't decode
+    # the destination json again.
+    destination = Destination()
+    destination_dict = self.DestinationDict()
+    if destination_dict and destination_dict["lat"] and destination_dict["lon"]:
+      destination.SetLocation(destination_dict["lat"], destination_dict["lon"])
+    return destination
+  
+  def DestinationDict(self):
+    """Get the destination as a dictionary, decoding it at most once."""
+    if self.decoded_destination is None and self.destination is not None:
+      self.decoded_destination = json.loads(self.destination)
+    return self.decoded_destination
   
   def SetDestination(self, destination):
     self.destination = destination.ToString()
+    self.decoded_destination = destination.DictForJson()
   
   def Entities(self):
     """Iterate over all Entities in the game."""
@@ -537,46 +722,62 @@ class Game(db.Model):
     yield self.Destination()
   
   def VisibleEntities(self):
+    is_visible = self.VisibilityFilter()
     for entity in self.Entities():
-      if self.IsVisible(entity):
+      if is_visible(entity.Lat(), entity.Lon()):
         yield entity
   
-  def Advance(self):
+  def Advance(self, email):
+    """Advance the game to the current time, and process triggers against the
+    player with the given email (the current user)."""
     timedelta = datetime.datetime.now() - self.last_update_time
     seconds = timedelta.seconds + timedelta.microseconds / float(1e6)
     seconds_to_move = min(seconds, MAX_TIME_INTERVAL_SECS)
     
+    # Players commit themselves to their tiles when invalidated, and zombies
+    # don't change when invalidated, so neither needs to be set again here.
     for entity in self.VisibleEntities():
       entity.Invalidate(timedelta)
-    for player in self.Players():
-      self.SetPlayer(player)
-    for zombie in self.Zombies():
-      self.SetZombie(zombie)
 
-    updated_zombies = []
-    for zombie in self.Zombies():
-      zombie.Advance(seconds_to_move, 
-                     self.PlayersInPlay(), 
-                     self.Fortifications())
-      updated_zombies.append(zombie)
+    # Collect the players in play and the fortifications once, rather than
+    # once per zombie.
+    players = list(self.PlayersInPlay())
+    player_points = LatLonPoints(players)
+    fortification_points = LatLonPoints(
+        [f for f in self.Fortifications(players)
+         if f.Lat() is not None and f.Lon() is not None])
+
+    zombies = list(self.Zombies())
+    for zombie in zombies:
+      zombie.Advance(seconds_to_move,
+                     players,
+                     player_points,
+                     fortification_points)
       
-    for zombie in updated_zombies:
+    for zombie in zombies:
       self.SetZombie(zombie)
       
     # Perform triggers on the current user.
-    player = self.GetPlayer(users.get_current_user().email())
+    player = self.GetPlayer(email)
     if player.Lat() is not None and player.Lon() is not None:
       # Trigger destination first, so that when a player has reached the
       # destination at the same time they were caught by a zombie, we give them
       # the benefit of the doubt.
       destination = self.Destination()
       if destination.Lat() is not None and destination.Lon() is not None and \
-          player.DistanceFrom(destination) < TRIGGER_DISTANCE_METERS:
+          player.DistanceFromLatLonApprox(destination.Lat(),
+                                          destination.Lon()) < \
+          TRIGGER_DISTANCE_METERS:
         destination.Trigger(player)
   
-      for zombie in self.ZombiesAndInfectedPlayers():
-        if player.DistanceFrom(zombie) < TRIGGER_DISTANCE_METERS:
-          zombie.Trigger(player)
+      # Reuse the zombies we've already advanced rather than collecting them
+      # from the game tiles again.
+      triggers = [z for z in zombies + list(self.ZombiePlayers())
+                  if z.Lat() is not None and z.Lon() is not None]
+      for i, distance in PointsWithin(player.Lat(), player.Lon(),
+                                      LatLonPoints(triggers),
+                                      TRIGGER_DISTANCE_METERS):
+        triggers[i].Trigger(player)
       self.SetPlayer(player)
     
     # self._GameTileWindow().RepopulateZombies()
@@ -615,6 +816,15 @@ class GameTile(db.Model):
     self.decoded_players = None
     self.decoded_zombies = None
     
+  def ToMemcacheBlob(self):
+    """Encode this tile for memcache; see Game.ToMemcacheBlob."""
+    return db.model_to_protobuf(self).Encode()
+
+  @classmethod
+  def FromMemcacheBlob(cls, blob):
+    """Decode a tile encoded with ToMemcacheBlob, without a datastore hit."""
+    return db.model_from_protobuf(blob)
+    
   def Id(self):
     """Get the id of the game tile.  The id is specific to a game, and cannot
     be used outside of that context."""
@@ -642,31 +852,62 @@ class GameTile(db.Model):
     return self.NW()[0] - GAME_TILE_LAT_SPAN, self.NW()[1] + GAME_TILE_LON_SPAN
   
   def Players(self):
-    return [Player(e, tile=self) for e in self.players]
+    """Get the players in this tile.  The players are decoded once, and kept in
+    decoded_players alongside the encoded players."""
+    if self.decoded_players is None:
+      logging.debug("Decoding Players in game tile %d.", self.Id())
+      self.decoded_players = [Player(e, tile=self) for e in self.players]
+    # Return a copy, since committing a player while iterating over the players
+    # modifies decoded_players.
+    return list(self.decoded_players)
+  
+  def PlayerDicts(self):
+    return [json.loads(e) for e in self.players]
   
   def AddPlayer(self, player):
-    logging.debug("Adding player %s to tile %s" %
-                  (player.ToString(), self.Id()))
+    encoded = player.ToString()
+    logging.debug("Adding player %s to tile %s", encoded, self.Id())
     if self.HasPlayer(player):
       self.RemovePlayer(player)
-    self.players.append(player.ToString())
+    self.players.append(encoded)
     self.player_emails.append(player.Email())
+    if self.decoded_players is not None:
+      player.tile = self
+      self.decoded_players.append(player)
+  
+  def PlayerIndexByEmail(self, email):
+    """Get the index of the player with the given email in players, or None if
+    the player is not in this tile.
+    
+    player_emails is kept parallel to players, so this doesn't need to decode
+    any players.
+    """
+    try:
+      return self.player_emails.index(email)
+    except ValueError:
+      return None
+  
+  def GetPlayer(self, email):
+    i = self.PlayerIndexByEmail(email)
+    if i is None:
+      return None
+    if self.decoded_players is not None:
+      return self.decoded_players[i]
+    return Player(self.players[i], tile=self)
   
   def HasPlayer(self, player):
-    for p in self.Players():
-      if p.Email() == player.Email():
-        return True
-    return False
+    return player.Email() in self.player_emails
   
   def RemovePlayer(self, player):
-    while self.HasPlayer(player):
-      for i, p in enumerate(self.Players()):
-        if p.Email() == player.Email():
-          logging.debug("Removing player %s from tile %d" %
-                        (player.Email(), self.Id()))
-          self.players.pop(i)
-          self.player_emails.pop(i)
-          break
+    i = self.PlayerIndexByEmail(player.Email())
+    while i is not None:
+      logging.debug("Removing player %s from tile %d",
+                    player.Email(), self.Id())
+      self.players.pop(i)
+      self.player_emails.pop(i)
+      if self.decoded_players is not None:
+        self.decoded_players.pop(i)
+      i = self.PlayerIndexByEmail(player.Email())
     
   def SetPlayer(self, player):
     self.RemovePlayer(player)
@@ -676,18 +917,20 @@ class GameTile(db.Model):
     if self.decoded_zombies is not None:
       return self.decoded_zombies
     
-    logging.debug("Decoding Zombies in game tile %d." % self.Id())
+    logging.debug("Decoding Zombies in game tile %d.", self.Id())
     self.decoded_zombies = [Zombie(e) for e in self.zombies]
     return self.decoded_zombies
   
+  def ZombieDicts(self):
+    # Zombies that have been decoded may have changed since they were last
+    # encoded, so use the decoded versions when we have them.
+    if self.decoded_zombies is not None:
+      return [z.DictForJson() for z in self.decoded_zombies]
+    return [json.loads(e) for e in self.zombies]
+  
   def NumZombies(self):
     return len(self.zombies)
   
-  def ZombiesPerSqKm(self):
-    count = self.NumZombies()
-    area = self.AreaSqKm()
-    return count / area
-  
   def _AddZombie(self, zombie):
     if not self.HasZombie(zombie):
       self.zombies.append(zombie.ToString())
@@ -705,47 +948,66 @@ class GameTile(db.Model):
         self.zombies.pop(i)
         self.decoded_zombies.pop(i)
         return
-    logging.warn("Could not find zombie %s in game tile %d" %
-                 (zombie.ToString(), self.Id()))
+    logging.warn("Could not find zombie %s in game tile %d",
+                 zombie.Id(), self.Id())
   
   def SetZombie(self, zombie):
+    # Only the decoded zombie is updated here; the encoded zombies are
+    # rewritten once by Flush, before the tile is put.
     for i, z in enumerate(self.Zombies()):
       if ZombieEquals(z, zombie):
-        self.zombies[i] = zombie.ToString()
         self.decoded_zombies[i] = zombie
         return
-    logging.warn("Could not find zombie %s in game tile %d" %
-                 (zombie.ToString(), self.Id()))
-    logging.info("Zombies: %s" % [z.ToString() for z in self.Zombies()])
+    logging.warn("Could not find zombie %s in game tile %d",
+                 zombie.Id(), self.Id())
+    if logging.getLogger().isEnabledFor(logging.INFO):
+      logging.info("Zombies: %s", [z.Id() for z in self.Zombies()])
+    
+  def Flush(self):
+    """Re-encode the decoded zombies into the zombies StringListProperty.
+    
+    Must be called before the tile is put to the datastore or memcache, so that
+    the stored zombies reflect any changes made through SetZombie.
+    """
+    if self.decoded_zombies is not None:
+      self.zombies = [z.ToString() for z in self.decoded_zombies]
     
   def PopulateZombies(self):
     if self.Id() == UNLOCATED_TILE_ID:
       logging.debug("Not populating zombies in the unlocated tile.")
       return
     
-    logging.debug("Populating zombies in tile %d" % self.Id())
-    while self.ZombiesPerSqKm() < DEFAULT_ZOMBIE_DENSITY:
+    logging.debug("Populating zombies in tile %d", self.Id())
+    # Everything that doesn't change as zombies are added is computed once, up
+    # front, rather than once per cluster or per zombie.
+    target_num_zombies = DEFAULT_ZOMBIE_DENSITY * self.AreaSqKm()
+    nw_lat, nw_lon = self.NW()
+    player_points = LatLonPoints(
+        [p for p in self.Players() if p.Lat() is not None and
+                                      p.Lon() is not None])
+    zombies = self.Zombies()
+    while len(zombies) < target_num_zombies:
       zombie_cluster_size = random.randint(1, MAX_ZOMBIE_CLUSTER_SIZE)
       cluster_added = False
       while not cluster_added:
-        cluster_added = self._AddZombieCluster(zombie_cluster_size)
-  
-  def _AddZombieCluster(self, num_zombies):
-    cluster_lat = self.NW()[0] - random.uniform(0, GAME_TILE_LAT_SPAN)
-    cluster_lon = self.NW()[1] + random.uniform(0, GAME_TILE_LON_SPAN)
+        cluster_added = self._AddZombieCluster(zombie_cluster_size,
+                                               nw_lat,
+                                               nw_lon,
+                                               player_points)
+  
+  def _AddZombieCluster(self, num_zombies, nw_lat, nw_lon, player_points):
+    cluster_lat = nw_lat - random.uniform(0, GAME_TILE_LAT_SPAN)
+    cluster_lon = nw_lon + random.uniform(0, GAME_TILE_LON_SPAN)
     
-    for player in self.Players():
-      if DistanceBetween(player.Lat(), 
-                         player.Lon(), 
-                         cluster_lat, 
-                         cluster_lon) < MIN_ZOMBIE_DISTANCE_FROM_PLAYER:
-        logging.debug("Declining to add zombie cluster due to player "
-                      "proximity.")
-        return False
+    if PointsWithin(cluster_lat, cluster_lon, player_points,
+                    MIN_ZOMBIE_DISTANCE_FROM_PLAYER):
+      logging.debug("Declining to add zombie cluster due to player "
+                    "proximity.")
+      return False
     
     logging.debug("Adding zombie cluster to tile %d of size %d with center "
-                  "(%f, %f)" %
-                  (self.Id(), num_zombies, cluster_lat, cluster_lon))
+                  "(%f, %f)",
+                  self.Id(), num_zombies, cluster_lat, cluster_lon)
     for i in xrange(num_zombies):
       self._AddZombieAt(cluster_lat,
                         cluster_lon)
@@ -763,31 +1025,30 @@ class GameTile(db.Model):
     zombie = Zombie(speed=speed, guid=str(uuid.uuid4()))
     zombie.SetLocation(lat, lon)
 
-    logging.debug("Adding zombie %s to tile %d." % 
-                  (zombie.ToString(), self.Id()))
+    encoded = zombie.ToString()
+    logging.debug("Adding zombie %s to tile %d.", encoded, self.Id())
     
-    self._AddZombie(zombie)
+    # The zombie has a brand new guid, so unlike _AddZombie there's no need to
+    # check whether the tile already has it.
+    self.zombies.append(encoded)
+    self.Zombies().append(zombie)
 
   def _RandomPointNear(self, lat, lon, distance):
+    """Get a point the given distance in meters from (lat, lon), in a random
+    direction."""
     radians = math.pi * 2 * random.random()
-    to_lat = lat + math.sin(radians)
-    to_lon = lon + math.cos(radians)
-
-    base_to_distance = DistanceBetween(lat, lon, to_lat, to_lon)
-    magnitude = distance / base_to_distance
-    
-    dLat = (to_lat - lat) * magnitude
-    dLon = (to_lon - lon) * magnitude
-    
-    return (lat + dLat, lon + dLon) 
+    dLat = distance / METERS_PER_DEGREE_LAT * math.sin(radians)
+    dLon = distance / (METERS_PER_DEGREE_LAT *
+                       math.cos(lat * DEGREES_TO_RADIANS)) * math.cos(radians)
+    return (lat + dLat, lon + dLon)
   
 
 class GameTileWindow():
   """A GameTileWindow is a utility class for dealing with a set of GameTiles."""
 
   def __init__(self, game, lat, lon, radius_meters):
-    logging.debug("Initializing GameTileWindow for lat, lon (%f, %f)" %
-                 (lat, lon))
+    logging.debug("Initializing GameTileWindow for lat, lon (%f, %f)",
+                 lat, lon)
     self.game = game
     
     # Map from game tile id to game tile instance.
@@ -823,7 +1084,7 @@ class GameTileWindow():
         self._TileForLatLon(tileLat, tileLon)
         tileLon += GAME_TILE_LON_SPAN
       tileLat -= GAME_TILE_LAT_SPAN
-    logging.debug("Loaded %d GameTiles." % len(self.tiles))
+    logging.debug("Loaded %d GameTiles.", len(self.tiles))
     
   def Lat(self):
     return self.lat
@@ -832,10 +1093,15 @@ class GameTileWindow():
     return self.lon
     
   def PutTiles(self, force_datastore_put=True):
-    logging.debug("Putting %d game tiles." % len(self.tiles))
+    logging.debug("Putting %d game tiles.", len(self.tiles))
+    self._FlushTiles()
     self._PutTilesToDatastore(force_datastore_put)
     self._PutTilesToMemcache()
     
+  def _FlushTiles(self):
+    for tile in self.tiles.itervalues():
+      tile.Flush()
+    
   def _PutTilesToDatastore(self, force_datastore_put):
     datastore_tiles = []
 
@@ -851,7 +1117,7 @@ class GameTileWindow():
           tile.last_update_time = now
 
     if datastore_tiles:
-      logging.info("Putting %d game tiles to datastore." % len(datastore_tiles))
+      logging.info("Putting %d game tiles to datastore.", len(datastore_tiles))
       db.put(datastore_tiles)
     else:
       logging.debug("No game tiles put to datastore.")
@@ -860,14 +1126,14 @@ class GameTileWindow():
     mapping = {}
     for tile in self.tiles.values():
       key = self._GetGameTileKeyName(tile.Id())
-      mapping[key] = db.model_to_protobuf(tile)
+      mapping[key] = tile.ToMemcacheBlob()
 
     for email in self.players:
       key = self._GetPlayerTileLocationKeyName(email)
       mapping[key] = self.players[email]
       
     if len(mapping):
-      logging.debug("Putting %d game tiles to memcache." % len(mapping))
+      logging.debug("Putting %d game tiles to memcache.", len(mapping))
       memcache.set_multi(mapping)
     else:
       logging.debug("Not putting any game tiles to memcache.")
@@ -875,9 +1141,10 @@ class GameTileWindow():
   def GetPlayer(self, email):
     def FindInLoadedTiles(email):
       # Do we already have this player in view?
-      for player in self.Players():
-        if player.Email() == email:
-          logging.debug("Found player %s in preloaded game tiles." % email)
+      for tile in self.tiles.itervalues():
+        player = tile.GetPlayer(email)
+        if player:
+          logging.debug("Found player %s in preloaded game tiles.", email)
           return player
     
     player = FindInLoadedTiles(email)
@@ -887,7 +1154,7 @@ class GameTileWindow():
     # Do we have the player's location registered in memcache?
     tile_id = memcache.get(self._GetPlayerTileLocationKeyName(email))
     if tile_id:
-      logging.info("Found location of player %s from memcache." % email)
+      logging.info("Found location of player %s from memcache.", email)
       self._LoadGameTile(tile_id)
       player = FindInLoadedTiles(email)
       if player:
@@ -895,7 +1162,7 @@ class GameTileWindow():
 
     # Query the datastore for the game tile that contains the player, and load
     # it.
-    logging.info("Querying datastore for game tile containing player %s" % 
+    logging.info("Querying datastore for game tile containing player %s",
                  email)
     query = GameTile.all()
     query.filter("player_emails = ", email)
@@ -903,24 +1170,38 @@ class GameTileWindow():
     query.order("-last_update_time")
     tile = query.get()
     if tile is not None:
-      logging.info("Found player %s in game tile %d from datastore." %
-                   (email, tile.Id()))
+      logging.info("Found player %s in game tile %d from datastore.",
+                   email, tile.Id())
       self.tiles[tile.Id()] = tile
       player = FindInLoadedTiles(email)
       if player:
         return player
 
-    logging.warn("Did not find player %s in any game tiles." % email)
+    logging.warn("Did not find player %s in any game tiles.", email)
     return None
   
+  def HasPlayer(self, email):
+    # Check the emails of the tiles we already have loaded before falling back
+    # to GetPlayer, which decodes the player and may have to load a tile.
+    for tile in self.tiles.itervalues():
+      if email in tile.player_emails:
+        return True
+    return self.GetPlayer(email) is not None
+  
   def Players(self):
+    players = []
     for tile in self.tiles.itervalues():
-      for player in tile.Players():
-        yield player
+      players.extend(tile.Players())
+    return players
+
+  def PlayerDicts(self):
+    for tile in self.tiles.itervalues():
+      for player_dict in tile.PlayerDicts():
+        yield player_dict
 
   def AddPlayer(self, player):
     tile = self._TileForEntity(player)
-    logging.debug("Adding player %s to tile %d" % (player.Email(), tile.Id()))
+    logging.debug("Adding player %s to tile %d", player.Email(), tile.Id())
     tile.AddPlayer(player)
   
   def RemovePlayer(self, player):
@@ -929,13 +1210,21 @@ class GameTileWindow():
       tile.RemovePlayer(player)
   
   def SetPlayer(self, player):
-    logging.debug("Setting player %s" % player.Email())
-    old_tile = self._TileForEntity(self.GetPlayer(player.Email()))
+    logging.debug("Setting player %s", player.Email())
+    # Decoded players are shared, so the player we're given may be the same
+    # object as the one stored in its old tile, with its new location already
+    # set.  Take the old tile from the tile the stored player was found in,
+    # rather than from its location.
+    old_player = self.GetPlayer(player.Email())
+    old_tile = None
+    if old_player:
+      old_tile = old_player.tile
     new_tile = self._TileForEntity(player)
     self.RemovePlayer(player)
     self.AddPlayer(player)
     
     if old_tile != new_tile:
+      self._FlushTiles()
       self._PutTilesToMemcache()
       self._PutTilesToDatastore(True)
 
@@ -946,6 +1235,11 @@ class GameTileWindow():
         zombies.append(zombie)
     return zombies
   
+  def ZombieDicts(self):
+    for tile in self.tiles.itervalues():
+      for zombie_dict in tile.ZombieDicts():
+        yield zombie_dict
+  
   def NumZombies(self):
     return sum([tile.NumZombies() for tile in self.tiles.itervalues()])
   
@@ -959,8 +1253,8 @@ class GameTileWindow():
     
     new_tile = self._TileForEntity(zombie)
     if new_tile != original_tile:
-      logging.debug("Zombie moved from tile %s to tile %s." %
-                    (original_tile.Id(), new_tile.Id()))
+      logging.debug("Zombie moved from tile %s to tile %s.",
+                    original_tile.Id(), new_tile.Id())
       original_tile.RemoveZombie(zombie)
       new_tile._AddZombie(zombie)
     else:
@@ -1047,20 +1341,20 @@ class GameTileWindow():
       return self._GetOrCreateGameTile(id)
   
   def _LoadGameTile(self, id):
-    logging.debug("Loading game tile %d" % id)
+    logging.debug("Loading game tile %d", id)
     if (self._LoadGameTileFromMemcache(id) or
         self._LoadGameTileFromDatastore(id)):
       # Build our player tile id cache.
       for tile in self.tiles.itervalues():
-        for player in tile.Players():
-          self.players[player.Email()] = tile.Id()
+        for email in tile.player_emails:
+          self.players[email] = tile.Id()
       
       return True
     return False
     
   def _LoadGameTileFromMemcache(self, id):
     key = self._GetGameTileKeyName(id)
-    logging.debug("Looking up entry %s in memcache." % key)
+    logging.debug("Looking up entry %s in memcache.", key)
     encoded = memcache.get(self._GetGameTileKeyName(id))
     
     if not encoded:
@@ -1069,11 +1363,11 @@ class GameTileWindow():
     logging.debug("Memcache game tile hit.")
     
     try:
-      tile = db.model_from_protobuf(encoded)
+      tile = GameTile.FromMemcacheBlob(encoded)
       self.tiles[id] = tile
       return True
     except db.Error, e:
-      logging.error("Protobuf Decode Error on GameTile: %s" % e)
+      logging.error("Protobuf Decode Error on GameTile: %s", e)
       return False
   
   def _LoadGameTileFromDatastore(self, id):
@@ -1084,10 +1378,10 @@ class GameTileWindow():
     # transaction.  For now, let's just let it be, and we'll deal with the
     # consequences later.  This will hopefully be an edge case.
     tile_key = self._GetGameTileKeyName(id)
-    logging.debug("Loading game tile %s from datastore." % tile_key)
+    logging.debug("Loading game tile %s from datastore.", tile_key)
     tile = GameTile.get_by_key_name(tile_key)
     if tile is None:
-      logging.debug("Initializing new game tile %d" % id)
+      logging.debug("Initializing new game tile %d", id)
       
       geopt = None
       if id != UNLOCATED_TILE_ID: